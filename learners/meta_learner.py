@@ -1,4 +1,5 @@
 from sys import path
+import sys
 import torch
 from torch.utils.data import DataLoader
 import numpy as np
@@ -8,7 +9,7 @@ import yaml
 from time import time
 import os
 
-from utils.utils import dict2namespace, split_dataset, init_c, get_meta_optimizer, plot_images, get_measurement_images
+from utils.utils import dict2namespace, split_dataset, init_c, get_meta_optimizer, plot_images, get_measurement_images, load_yaml
 from utils.loss_utils import get_A, get_measurements, get_likelihood_grad, get_meta_grad, get_loss_dict
 from utils.alg_utils import SGLD_inverse, hessian_vector_product, Ax, cg_solver, SGLD_inverse_eval
 from utils.metrics_utils import Metrics
@@ -26,6 +27,9 @@ class MetaLearner:
     def __init__(self, hparams, args):
         self.hparams = hparams
         self.args = args
+        #progress bars are only drawn on a terminal; the per-batch bars are transient and refresh at most once a second
+        self.outer_tqdm_kwargs = dict(disable=not sys.stdout.isatty())
+        self.inner_tqdm_kwargs = dict(disable=not sys.stdout.isatty(), leave=False, mininterval=1.0)
         self.__init_net()
         self.__init_datasets()
         self.__init_problem()
@@ -47,8 +51,7 @@ class MetaLearner:
         ckpt_path = self.hparams.net.checkpoint_dir
         config_path = self.hparams.net.config_file
 
-        with open(config_path, 'r') as f:
-            config = yaml.safe_load(f)
+        config = load_yaml(config_path)
         net_config = dict2namespace(config)
         net_config.device = self.hparams.device
 
@@ -69,10 +72,21 @@ class MetaLearner:
             ema_helper.load_state_dict(states[-1])
             ema_helper.ema(test_score)
 
+        #the wrapper is only needed to load the "module." checkpoint keys; DataParallel re-replicates the
+        #net on every forward of the inner loop, so only keep it when there really are several GPUs to use
+        if not (self.hparams.gpu_num == -1 and torch.cuda.device_count() > 1):
+            test_score = test_score.module
+
         test_score.eval()
         for param in test_score.parameters():
             param.requires_grad = False
 
+        #the score net is called with fixed shapes for every inner step, so a compiled graph pays off quickly
+        if self.hparams.net.compile:
+            if not hasattr(torch, 'compile'):
+                raise RuntimeError("net.compile requires torch>=2.0 (torch.compile not available)")
+            test_score = torch.compile(test_score, dynamic=False)
+
         self.model = test_score
         self.sigmas = get_sigmas(net_config).cpu()
         self.model_config = net_config
@@ -102,14 +116,26 @@ class MetaLearner:
         val_dataset = split_dict['val']
         test_dataset = split_dict['test']
 
+        num_workers = self.hparams.data.num_workers
+        loader_kwargs = {
+            'num_workers': num_workers,
+            'pin_memory': self.hparams.device.type == 'cuda',
+            #keep workers (and their per-worker lmdb handles) alive across the many passes over each loader
+            'persistent_workers': num_workers > 0,
+            'worker_init_fn': getattr(base_dataset, 'worker_init_fn', None)
+        }
+        #DataLoader rejects prefetch_factor without worker processes
+        if num_workers > 0:
+            loader_kwargs['prefetch_factor'] = self.hparams.data.prefetch_factor
+
         if self.hparams.outer.use_validation:
             self.val_loader = DataLoader(val_dataset, batch_size=self.hparams.data.val_batch_size, shuffle=False,
-                        num_workers=1, drop_last=True)
+                                drop_last=True, **loader_kwargs)
 
         self.train_loader = DataLoader(train_dataset, batch_size=self.hparams.data.train_batch_size, shuffle=True,
-                                num_workers=1, drop_last=True)
+                                drop_last=True, **loader_kwargs)
         self.test_loader = DataLoader(test_dataset, batch_size=self.hparams.data.val_batch_size, shuffle=False,
-                                num_workers=1, drop_last=True)
+                                drop_last=True, **loader_kwargs)
 
         if self.hparams.outer.verbose:
             end = time()
@@ -138,7 +164,7 @@ class MetaLearner:
         else:
             self.noise_vars = None
 
-        self.c = init_c(self.hparams).to(self.hparams.device)
+        self.c = init_c(self.hparams, self.hparams.device)
 
         opt_dict = get_meta_optimizer(self.c, self.hparams)
         self.meta_opt = opt_dict['meta_opt']
@@ -147,15 +173,17 @@ class MetaLearner:
         #values used for loss min appx
         s_idx = len(self.sigmas)-1
         self.loss_scale = 1 / (self.sigmas[s_idx]**2)
-        self.labels = torch.ones(self.hparams.data.train_batch_size, device=self.hparams.device) * s_idx
-        self.labels = self.labels.long()
+        self.labels = torch.full((self.hparams.data.train_batch_size,), s_idx, dtype=torch.long, device=self.hparams.device)
 
         self.global_iter = 0
         self.best_iter = 0
 
         self.grad_norms = []
+        #grads and c_list only hold the snapshots the logger hasn't streamed to disk yet - 
+        #the full histories live in grads.pickle and c_list.pickle
         self.grads = []
-        self.c_list = [self.c.detach().cpu()]
+        self.c_list = [self.c.detach().to('cpu', copy=True)]
+        self.best_c = self.c_list[0]
 
         self.ROI = self.hparams.outer.ROI 
         if self.hparams.outer.ROI:
@@ -178,34 +206,41 @@ class MetaLearner:
         if self.hparams.outer.verbose and self.global_iter > 0:
             print("\nLOADING SAVED INITIALIZATONS\n")
 
-        out_x = None
+        #fill one preallocated batch instead of re-concatenating a growing tensor per index
+        #pinned when the target is a gpu so the upload below can be asynchronous
+        out_x = torch.empty((len(indices),) + tuple(self.hparams.data.image_shape), 
+                            pin_memory=self.hparams.device.type == 'cuda')
 
-        for i in indices:
+        for j, i in enumerate(indices):
             if str(i) not in self.x_inits:
                 self.x_inits[str(i)] = torch.rand(self.hparams.data.image_shape)
             
-            if out_x is None:
-                out_x = self.x_inits[str(i)].clone().unsqueeze(0)
-            else:
-                out_x = torch.cat((out_x, self.x_inits[str(i)].unsqueeze(0)), 0)
-        
-        if len(out_x.shape) == 3:
-            out_x = out_x.unsqueeze(0)
+            out_x[j].copy_(self.x_inits[str(i)])
         
-        return out_x.to(self.hparams.device).requires_grad_()
+        return out_x.to(self.hparams.device, non_blocking=True).requires_grad_()
     
     def __save_inits(self, x_out, indices):
         """Method for saving initializations at the end of a training loop"""
         if self.hparams.outer.verbose:
             print("\SAVING INITIALIZATONS\n")
 
+        #one device->host copy for the whole batch rather than one (plus a device clone) per image
+        x_host = x_out.detach().to('cpu', copy=True)
+
         for x_i, i in enumerate(indices):
-            self.x_inits[str(i)] = x_out[x_i].detach().cpu().clone()
+            #own storage per image so a stale batch isn't kept alive by a few surviving rows
+            self.x_inits[str(i)] = x_host[x_i].clone()
 
         return
     
+    def __to_host(self, tensor):
+        """Method for taking a host snapshot of a tensor"""
+        #copy=True so a cpu tensor isn't aliased, since c is updated in place by the optimizer.
+        #blocking on purpose - the checkpoint thread may read the snapshot at any time, and c is small
+        return tensor.detach().to('cpu', copy=True)
+
     def run_meta_opt(self):
-        for iter in tqdm(range(self.hparams.outer.num_iters)):
+        for iter in tqdm(range(self.hparams.outer.num_iters), **self.outer_tqdm_kwargs):
             #checkpointing
             if not self.hparams.outer.debug and iter % self.hparams.outer.checkpoint_iters == 0:
                 self.logger.checkpoint()
@@ -223,7 +258,7 @@ class MetaLearner:
         
         #replace current c with the one from the best iteration
         if self.hparams.outer.use_validation:
-            self.c.copy_(self.c_list[self.best_iter])
+            self.c.copy_(self.best_c)
 
         #Test
         if self.hparams.outer.verbose:
@@ -239,6 +274,8 @@ class MetaLearner:
         
         if not self.hparams.outer.debug:
             self.logger.checkpoint()
+            self.logger.wait_for_checkpoint()
+            self.logger.wait_for_images()
 
         return
     
@@ -246,39 +283,42 @@ class MetaLearner:
         self.meta_opt.zero_grad()
         meta_grad = self.outer_step()
 
-        self.c.requires_grad_()
-        if type(self.c.grad) == type(None): #dummy update to make sure grad is initialized
-            dummy_loss = torch.sum(self.c)
-            dummy_loss.backward()
-        self.c.grad.copy_(meta_grad)
+        #the optimizer only reads .grad, so hand it the meta-gradient directly - no dummy backward needed
+        self.c.grad = meta_grad.detach()
         self.meta_opt.step()
-        self.c.requires_grad_(False)
 
         if self.hparams.outer.lr_decay and not self.hparams.outer.decay_on_val:
             self.meta_scheduler.step()
-            print("\nDECAYING LR\n")
+            if self.hparams.outer.verbose:
+                print("\nDECAYING LR\n")
 
-        self.grads.append(meta_grad.detach().cpu())
+        #in debug mode nothing is checkpointed, so nothing would ever drain them
+        if not self.hparams.outer.debug:
+            self.grads.append(self.__to_host(meta_grad))
+            self.c_list.append(self.__to_host(self.c))
         self.grad_norms.append(torch.norm(meta_grad.flatten()).item())
-        self.c_list.append(self.c.detach().cpu())
 
         if self.hparams.outer.verbose:
             print("\nTRAIN LOSS: ", self.metrics.get_metric(self.global_iter, 'train', self.val_metric), '\n')
             print('\n', self.metrics.get_all_metrics(self.global_iter, 'train'), '\n')
             print("\nGRADIENT NORM: ", self.grad_norms[-1], '\n')
-            print("\nC MEAN: ", torch.mean(self.c_list[-1]), '\n')
-            print("\nC STD: ", torch.std(self.c_list[-1]), '\n')
-            print("\nC MIN: ", torch.min(self.c_list[-1]), '\n')
-            print("\nC MAX: ", torch.max(self.c_list[-1]), '\n')
+            #all four stats in one stacked reduction and a single host transfer
+            c_std, c_mean = torch.std_mean(self.c)
+            c_mean, c_std, c_min, c_max = torch.stack([c_mean, c_std, torch.min(self.c), torch.max(self.c)]).tolist()
+            print("\nC MEAN: ", c_mean, '\n')
+            print("\nC STD: ", c_std, '\n')
+            print("\nC MIN: ", c_min, '\n')
+            print("\nC MAX: ", c_max, '\n')
 
         return 
     
     def outer_step(self):  
-        meta_grad = 0.0 
+        #accumulated in place into one buffer shaped like c
+        meta_grad = torch.zeros_like(self.c)
         n_samples = 0
         num_batches = self.hparams.outer.batches_per_iter
 
-        for i, (x, x_idx) in tqdm(enumerate(self.train_loader)):
+        for i, (x, x_idx) in tqdm(enumerate(self.train_loader), **self.inner_tqdm_kwargs):
             if num_batches == 0:
                 break
 
@@ -290,7 +330,7 @@ class MetaLearner:
                 self.c.requires_grad_()
             
             #(1) Find x(c) by running the inner optimization
-            x = x.to(self.hparams.device)
+            x = x.to(self.hparams.device, non_blocking=True)
             y = get_measurements(self.A, x, self.hparams, self.efficient_inp, noisy=self.noisy, noise_vars=self.noise_vars)
 
             if self.save_inits:
@@ -301,15 +341,17 @@ class MetaLearner:
             
             #(2) Find meta gradient
             if self.hparams.outer.meta_type == 'maml':
-                meta_grad += self.maml_step(x_hat, x)
+                meta_grad.add_(self.maml_step(x_hat, x))
             elif self.hparams.outer.meta_type == 'implicit':
-                meta_grad += self.implicit_maml_step(x_hat, x, y)
+                meta_grad.add_(self.implicit_maml_step(x_hat, x, y))
             elif self.hparams.outer.meta_type == 'mle':
-                meta_grad += self.mle_step(x_hat, x, y)
+                meta_grad.add_(self.mle_step(x_hat, x, y))
             else: 
                 raise NotImplementedError
             
-            x_hat.requires_grad_(False)
+            #drop the reference to the inner-loop graph (the whole unrolled chain for maml) before the
+            #metrics and bookkeeping, so it is freed now instead of surviving into the next batch
+            x_hat = x_hat.detach()
             self.c.requires_grad_(False)
 
             if self.save_inits:
@@ -329,7 +371,7 @@ class MetaLearner:
 
         self.metrics.aggregate_iter_metrics(self.global_iter, 'train', return_best=False)
         
-        meta_grad /= n_samples
+        meta_grad.div_(n_samples)
 
         return meta_grad
 
@@ -413,6 +455,7 @@ class MetaLearner:
             if new_best_dict is not None and self.val_metric in new_best_dict:
                 best_value = new_best_dict[self.val_metric]
                 self.best_iter = self.global_iter
+                self.best_c = self.__to_host(self.c)
                 if self.hparams.outer.verbose:
                     print("\nNEW BEST VAL LOSS: ", best_value, "\n")
             elif self.hparams.outer.lr_decay and self.hparams.outer.decay_on_val:
@@ -441,9 +484,9 @@ class MetaLearner:
             cur_loader = self.test_loader
             iter_type = 'test'
 
-        for i, (x, x_idx) in tqdm(enumerate(cur_loader)):
+        for i, (x, x_idx) in tqdm(enumerate(cur_loader), **self.inner_tqdm_kwargs):
             x_idx = x_idx.cpu().numpy().flatten()
-            x = x.to(self.hparams.device)
+            x = x.to(self.hparams.device, non_blocking=True)
             y = get_measurements(self.A, x, self.hparams, self.efficient_inp, noisy=self.noisy, noise_vars=self.noise_vars)
 
             x_mod = torch.rand(x.shape, device=self.hparams.device)
@@ -459,7 +502,7 @@ class MetaLearner:
                 # plot_images(x_hat, "Reconstructed")
                 if self.global_iter == 0 or not validate:
                     self.logger.add_tb_images(x, iter_type + "_imgs_" + str(self.global_iter))
-                    self.logger.add_tb_measurement_images(x, iter_type + "_meas_" + str(self.global_iter))
+                    self.logger.add_tb_measurement_images(x, iter_type + "_meas_" + str(self.global_iter), x_idx)
                     self.logger.save_images(x, x_idx, iter_type + "_imgs_" + str(self.global_iter))
                     self.logger.save_image_measurements(x, x_idx, iter_type + "_imgs_meas_" + str(self.global_iter))
                 self.logger.add_tb_images(x_hat, iter_type + "_recons_" + str(self.global_iter))
@@ -481,12 +524,15 @@ class MetaLearner:
         """Method for performing grid search. Returns the best found value of c within grid_vals"""
         c_losses = []
 
-        for i, c_val in tqdm(enumerate(grid_vals)):
+        for i, c_val in tqdm(enumerate(grid_vals), **self.outer_tqdm_kwargs):
+            #build each candidate directly on the device instead of on the cpu followed by a copy
             if self.hparams.outer.hyperparam_type == 'vector':
-                c_val = c_val * torch.ones(self.hparams.problem.num_measurements).to(self.hparams.device)
+                c_val = torch.full((self.hparams.problem.num_measurements,), float(c_val), device=self.hparams.device)
+            elif self.hparams.outer.hyperparam_type == 'scalar':
+                c_val = torch.tensor(float(c_val), device=self.hparams.device)
             print("\nTESTING C VALUE: ", grid_vals[i], '\n')
-            for j, (x, _) in tqdm(enumerate(self.train_loader)):
-                x = x.to(self.hparams.device)
+            for j, (x, _) in tqdm(enumerate(self.train_loader), **self.inner_tqdm_kwargs):
+                x = x.to(self.hparams.device, non_blocking=True)
                 y = get_measurements(self.A, x, self.hparams, self.efficient_inp, noisy=self.noisy, noise_vars=self.noise_vars)
 
                 x_mod = torch.rand(x.shape, device=self.hparams.device)
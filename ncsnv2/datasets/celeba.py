@@ -1,6 +1,7 @@
 import torch
 import os
 import PIL
+from concurrent.futures import ThreadPoolExecutor
 from ncsnv2.datasets.vision import VisionDataset
 from ncsnv2.datasets.utils import download_file_from_google_drive, check_integrity
 
@@ -62,10 +63,10 @@ class CelebA(VisionDataset):
         self.transform = transform
         self.target_transform = target_transform
 
-        if download:
-            self.download()
+        #download() already hashes every annotation file, so don't redo the md5 pass after it
+        verified = self.download() if download else False
 
-        if not self._check_integrity():
+        if not verified and not self._check_integrity():
             raise RuntimeError('Dataset not found or corrupted.' +
                                ' You can use download=True to download it')
 
@@ -106,12 +107,18 @@ class CelebA(VisionDataset):
         self.attr = (self.attr + 1) // 2  # map from {-1, 1} to {0, 1}
 
     def _check_integrity(self):
+        to_check = []
         for (_, md5, filename) in self.file_list:
             fpath = os.path.join(self.root, self.base_folder, filename)
             _, ext = os.path.splitext(filename)
             # Allow original archive to be deleted (zip and 7z)
             # Only need the extracted images
-            if ext not in [".zip", ".7z"] and not check_integrity(fpath, md5):
+            if ext not in [".zip", ".7z"]:
+                to_check.append((fpath, md5))
+
+        # hashlib releases the GIL on large reads, so the files hash concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(len(to_check), os.cpu_count() or 1))) as pool:
+            if not all(pool.map(lambda args: check_integrity(*args), to_check)):
                 return False
 
         # Should check a hash of the images
@@ -122,7 +129,7 @@ class CelebA(VisionDataset):
 
         if self._check_integrity():
             print('Files already downloaded and verified')
-            return
+            return True
 
         for (file_id, md5, filename) in self.file_list:
             download_file_from_google_drive(file_id, os.path.join(self.root, self.base_folder), filename, md5)
@@ -130,6 +137,8 @@ class CelebA(VisionDataset):
         with zipfile.ZipFile(os.path.join(self.root, self.base_folder, "img_align_celeba.zip"), "r") as f:
             f.extractall(os.path.join(self.root, self.base_folder))
 
+        return False
+
     def __getitem__(self, index):
         X = PIL.Image.open(os.path.join(self.root, self.base_folder, "img_align_celeba", self.filename[index]))
 
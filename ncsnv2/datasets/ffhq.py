@@ -1,14 +1,30 @@
 from io import BytesIO
 
 import lmdb
+import numpy as np
+import torch
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset, get_worker_info
 
 
 class FFHQ(Dataset):
     def __init__(self, path, transform, resolution=8):
-        self.env = lmdb.open(
-            path,
+        self.path = path
+
+        env = self._open_env()
+        with env.begin(write=False) as txn:
+            self.length = int(txn.get('length'.encode('utf-8')).decode('utf-8'))
+        env.close()
+
+        #opened lazily so every DataLoader worker gets its own handle instead of a forked copy
+        self.env = None
+
+        self.resolution = resolution
+        self.transform = transform
+
+    def _open_env(self):
+        env = lmdb.open(
+            self.path,
             max_readers=32,
             readonly=True,
             lock=False,
@@ -16,19 +32,36 @@ class FFHQ(Dataset):
             meminit=False,
         )
 
-        if not self.env:
-            raise IOError('Cannot open lmdb dataset', path)
+        if not env:
+            raise IOError('Cannot open lmdb dataset', self.path)
 
-        with self.env.begin(write=False) as txn:
-            self.length = int(txn.get('length'.encode('utf-8')).decode('utf-8'))
+        return env
 
-        self.resolution = resolution
-        self.transform = transform
+    def __getstate__(self):
+        #lmdb handles can't be pickled, so spawned workers reopen their own
+        state = self.__dict__.copy()
+        state['env'] = None
+        return state
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        #pass as the DataLoader's worker_init_fn (ideally with persistent_workers=True)
+        #drops any lmdb handle inherited through fork and gives each worker its own numpy seed
+        np.random.seed(torch.initial_seed() % 2**32)
+
+        dataset = get_worker_info().dataset
+        while isinstance(dataset, Subset):
+            dataset = dataset.dataset
+        if isinstance(dataset, FFHQ):
+            dataset.env = None
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, index):
+        if self.env is None:
+            self.env = self._open_env()
+
         with self.env.begin(write=False) as txn:
             key = f'{self.resolution}-{str(index).zfill(5)}'.encode('utf-8')
             img_bytes = txn.get(key)
@@ -38,4 +71,4 @@ class FFHQ(Dataset):
         img = self.transform(img)
         target = index
 
-        return img, target
\ No newline at end of file
+        return img, target
@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+pytest.importorskip("torchvision")
+pytest.importorskip("torch.utils.tensorboard")
+
+from utils.logging_utils import append_to_pickle, load_pickle_stream, save_to_pickle, load_metrics
+
+
+def test_pickle_stream_round_trip(tmp_path):
+    path = str(tmp_path / 'c_list.pickle')
+
+    assert load_pickle_stream(path) == []
+
+    first = [torch.randn(3), torch.randn(3)]
+    second = [torch.randn(3)]
+    append_to_pickle(first, path)
+    append_to_pickle(second, path)
+
+    loaded = load_pickle_stream(path)
+    assert len(loaded) == 3
+    for x, y in zip(first + second, loaded):
+        assert torch.equal(x, y)
+
+def test_load_metrics_round_trip(tmp_path):
+    metrics_root = str(tmp_path)
+
+    best = {'range': 1.0, 'best_train_metrics': {'psnr': (1, 30.0)}, 'best_val_metrics': {}, 'best_test_metrics': {}}
+    save_to_pickle(best, str(tmp_path / 'metrics.pickle'))
+
+    rows = [('iter_' + str(i), {'psnr': np.array([i, i + 1.0])}, {'mean_psnr': i + 0.5}) for i in range(3)]
+    append_to_pickle(rows[:2], str(tmp_path / 'train_metrics.pickle'))
+    append_to_pickle(rows[2:], str(tmp_path / 'train_metrics.pickle'))
+
+    metrics = load_metrics(metrics_root)
+
+    assert metrics['best_train_metrics'] == best['best_train_metrics']
+    assert list(metrics['train_metrics'].keys()) == ['iter_0', 'iter_1', 'iter_2']
+    assert np.array_equal(metrics['train_metrics']['iter_2']['psnr'], np.array([2, 3.0]))
+    assert metrics['train_metrics_aggregate']['iter_1'] == {'mean_psnr': 1.5}
+    assert metrics['val_metrics'] == {} and metrics['test_metrics_aggregate'] == {}
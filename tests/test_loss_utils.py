@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from utils.loss_utils import get_A, get_measurements, get_likelihood_grad, gradient_log_cond_likelihood, log_cond_likelihood_loss
+
+
+def make_hparams(A_type, c_type, use_autograd=True):
+    num_channels, image_size, downsample_factor = 3, 8, 2
+
+    if A_type == 'superres':
+        y_shape = (num_channels, image_size // downsample_factor, image_size // downsample_factor)
+    elif A_type == 'gaussian':
+        y_shape = (20,)
+    else:
+        y_shape = (num_channels, image_size, image_size)
+
+    return SimpleNamespace(
+        data=SimpleNamespace(n_input=num_channels * image_size**2, image_shape=(num_channels, image_size, image_size)),
+        problem=SimpleNamespace(measurement_type=A_type, downsample_factor=downsample_factor, y_shape=y_shape,
+                                num_measurements=int(torch.tensor(y_shape).prod())),
+        outer=SimpleNamespace(hyperparam_type=c_type, exp_params=False, use_autograd=use_autograd)
+    )
+
+def make_c(hparams):
+    m = hparams.problem.num_measurements
+    c_type = hparams.outer.hyperparam_type
+
+    if c_type == 'scalar':
+        return torch.tensor(0.7, dtype=torch.float64)
+    elif c_type == 'vector':
+        return torch.rand(m, dtype=torch.float64) + 0.5
+    else:
+        return torch.rand(m, m, dtype=torch.float64)
+
+def autograd_grad(c, y, A, x, hparams, scale):
+    x = x.clone().requires_grad_()
+    return torch.autograd.grad(log_cond_likelihood_loss(c, y, A, x, hparams, scale), x)[0]
+
+@pytest.mark.parametrize("A_type", ['gaussian', 'identity', 'superres'])
+@pytest.mark.parametrize("c_type", ['scalar', 'vector', 'matrix'])
+def test_likelihood_grad_matches_autograd(A_type, c_type):
+    torch.manual_seed(0)
+    hparams = make_hparams(A_type, c_type)
+
+    A = get_A(hparams)
+    if A is not None:
+        A = A.double()
+    c = make_c(hparams)
+    x = torch.rand((2,) + hparams.data.image_shape, dtype=torch.float64)
+    y = get_measurements(A, torch.rand_like(x), hparams)
+    scale = 3.0
+
+    expected = autograd_grad(c, y, A, x, hparams, scale)
+    actual = get_likelihood_grad(c, y, A, x, hparams, scale)
+
+    assert torch.allclose(actual, expected)
+
+@pytest.mark.parametrize("c_type", ['scalar', 'vector', 'matrix'])
+def test_superres_explicit_grad_is_not_the_true_gradient(c_type):
+    #interpolate is downsample_factor**2 times the adjoint of avg_pool2d,
+    #which is why superres must not take the explicit path when autograd is requested
+    torch.manual_seed(0)
+    hparams = make_hparams('superres', c_type)
+
+    c = make_c(hparams)
+    x = torch.rand((2,) + hparams.data.image_shape, dtype=torch.float64)
+    y = get_measurements(None, torch.rand_like(x), hparams)
+
+    expected = autograd_grad(c, y, None, x, hparams, 1.0)
+    explicit = gradient_log_cond_likelihood(c, y, None, x, hparams, 1.0)
+
+    assert torch.allclose(explicit, expected * hparams.problem.downsample_factor**2)
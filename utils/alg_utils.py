@@ -1,4 +1,5 @@
 import torch
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
 from utils import loss_utils
@@ -95,9 +96,9 @@ def cg_solver(f_Ax, b, hparams, x_init=None):
 
     for i in range(cg_iters):
         if verbose and i % verbose == 0:
+            #the three stats are reduced on the device and fetched with a single sync
             obj_fn = 0.5 * torch.sum(x * f_Ax(x)) - 0.5 * torch.sum(b * x)
-            norm_x = torch.norm(x)
-            norm_r = torch.norm(r)
+            norm_r, norm_x, obj_fn = torch.stack([torch.norm(r), torch.norm(x), obj_fn]).tolist()
             print(fmtstr % (i, norm_r, norm_x, obj_fn))
         
         rsold = torch.sum(r ** 2) 
@@ -119,8 +120,7 @@ def cg_solver(f_Ax, b, hparams, x_init=None):
 
     if verbose:
         obj_fn = 0.5 * torch.sum(x * f_Ax(x)) - 0.5 * torch.sum(b * x)
-        norm_x = torch.norm(x)
-        norm_r = torch.norm(r)
+        norm_r, norm_x, obj_fn = torch.stack([torch.norm(r), torch.norm(x), obj_fn]).tolist()
         print(fmtstr % (i+1, norm_r, norm_x, obj_fn))
         print("\n")
 
@@ -132,6 +132,7 @@ def SGLD_inverse(c, y, A, x_mod, model, sigmas, hparams, efficient_inp=False):
     decimate = hparams.inner.decimation_factor if hparams.inner.decimation_factor > 0 else False
     add_noise = True if hparams.inner.alg == 'langevin' else False
     maml_use_last = hparams.outer.maml_use_last
+    grad_checkpoint = hparams.inner.grad_checkpoint
     verbose = hparams.outer.verbose
 
     if verbose:
@@ -169,12 +170,14 @@ def SGLD_inverse(c, y, A, x_mod, model, sigmas, hparams, efficient_inp=False):
 
     #iterate over noise level index
     for t in used_levels:
-        sigma = sigmas[t]
+        #per-level constants as python floats, computed once here instead of as tensor ops every step
+        sigma = float(sigmas[t])
+        likelihood_scale = 1 / (sigma**2)
 
-        labels = torch.ones(x_mod.shape[0], device=x_mod.device) * t
-        labels = labels.long()
+        labels = torch.full((x_mod.shape[0],), int(t), dtype=torch.long, device=x_mod.device)
 
-        step_size = step_lr * (sigma / sigmas[-1]) ** 2
+        step_size = step_lr * (sigma / float(sigmas[-1])) ** 2
+        noise_scale = np.sqrt(step_size * 2)
 
         for s in range(T):
             if not create_graph and hparams.outer.meta_type == 'maml': 
@@ -185,25 +188,30 @@ def SGLD_inverse(c, y, A, x_mod, model, sigmas, hparams, efficient_inp=False):
                     if verbose:
                         print("\nStarting to track MAML gradient at iter " + str(step_num) + '\n')
 
-            prior_grad = model(x_mod, labels)
+            #when unrolling for maml, optionally recompute the score net's activations in the backward
+            #instead of keeping them alive for every inner step
+            if create_graph and grad_checkpoint:
+                prior_grad = checkpoint(model, x_mod, labels, use_reentrant=False)
+            else:
+                prior_grad = model(x_mod, labels)
 
-            likelihood_grad = loss_utils.get_likelihood_grad(c, y, A, x_mod, hparams, 1/(sigma**2), efficient_inp,\
+            likelihood_grad = loss_utils.get_likelihood_grad(c, y, A, x_mod, hparams, likelihood_scale, efficient_inp,\
                 retain_graph=create_graph, create_graph=create_graph)
 
             grad = prior_grad - likelihood_grad
 
             if add_noise:
                 noise = torch.randn_like(x_mod)
-                x_mod = x_mod + step_size * grad + noise * torch.sqrt(step_size * 2)
+                x_mod = x_mod + step_size * grad + noise * noise_scale
             else:
                 x_mod = x_mod + step_size * grad
 
             if verbose and (step_num % verbose == 0 or step_num == total_steps - 1):
                 with torch.no_grad():
-                    prior_grad_norm = torch.norm(prior_grad.view(prior_grad.shape[0], -1), dim=-1).mean().item()
-                    likelihood_grad_norm = torch.norm(likelihood_grad.view(likelihood_grad.shape[0], -1), dim=-1).mean().item()
-                    grad_norm = torch.norm(grad.view(grad.shape[0], -1), dim=-1).mean().item()
-                    likelihood_loss = loss_utils.simple_likelihood_loss(y, A, x_mod, hparams, efficient_inp).mean()
+                    #gather the four stats on the device and fetch them with a single sync
+                    stats = [torch.norm(g.view(g.shape[0], -1), dim=-1).mean() for g in (prior_grad, likelihood_grad, grad)]
+                    stats.append(loss_utils.simple_likelihood_loss(y, A, x_mod, hparams, efficient_inp).mean())
+                    prior_grad_norm, likelihood_grad_norm, grad_norm, likelihood_loss = torch.stack(stats).tolist()
 
                     print(fmtstr % (t, step_size, likelihood_loss, prior_grad_norm, likelihood_grad_norm, grad_norm))
       
@@ -224,6 +232,7 @@ def SGLD_inverse_eval(c, y, A, x_mod, model, sigmas, hparams, efficient_inp=Fals
     step_lr = hparams.inner.lr
     decimate = hparams.inner.decimation_factor if hparams.inner.decimation_factor > 0 else False
     add_noise = True if hparams.inner.alg == 'langevin' else False
+    use_autocast = hparams.inner.autocast and x_mod.is_cuda
     verbose = hparams.outer.verbose
 
     if verbose:
@@ -251,32 +260,37 @@ def SGLD_inverse_eval(c, y, A, x_mod, model, sigmas, hparams, efficient_inp=Fals
 
     #iterate over noise level index
     for t in used_levels:
-        sigma = sigmas[t]
+        #per-level constants as python floats, computed once here instead of as tensor ops every step
+        sigma = float(sigmas[t])
+        likelihood_scale = 1 / (sigma**2)
 
-        labels = torch.ones(x_mod.shape[0], device=x_mod.device) * t
-        labels = labels.long()
+        labels = torch.full((x_mod.shape[0],), int(t), dtype=torch.long, device=x_mod.device)
 
-        step_size = step_lr * (sigma / sigmas[-1]) ** 2
+        step_size = step_lr * (sigma / float(sigmas[-1])) ** 2
+        noise_scale = np.sqrt(step_size * 2)
 
         for s in range(T):
-            prior_grad = model(x_mod, labels)
+            #no meta-gradient flows through evaluation sampling, so the score net can run in bf16
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_autocast):
+                prior_grad = model(x_mod, labels)
+            prior_grad = prior_grad.float()
 
-            likelihood_grad = loss_utils.get_likelihood_grad(c, y, A, x_mod, hparams, 1/(sigma**2), efficient_inp)
+            likelihood_grad = loss_utils.get_likelihood_grad(c, y, A, x_mod, hparams, likelihood_scale, efficient_inp)
 
             grad = prior_grad - likelihood_grad
 
             if add_noise:
                 noise = torch.randn_like(x_mod)
-                x_mod = x_mod + step_size * grad + noise * torch.sqrt(step_size * 2)
+                x_mod = x_mod + step_size * grad + noise * noise_scale
             else:
                 x_mod = x_mod + step_size * grad
 
             if verbose and (step_num % verbose == 0 or step_num == total_steps - 1):
                 with torch.no_grad():
-                    prior_grad_norm = torch.norm(prior_grad.view(prior_grad.shape[0], -1), dim=-1).mean().item()
-                    likelihood_grad_norm = torch.norm(likelihood_grad.view(likelihood_grad.shape[0], -1), dim=-1).mean().item()
-                    grad_norm = torch.norm(grad.view(grad.shape[0], -1), dim=-1).mean().item()
-                    likelihood_loss = loss_utils.simple_likelihood_loss(y, A, x_mod, hparams, efficient_inp).mean()
+                    #gather the four stats on the device and fetch them with a single sync
+                    stats = [torch.norm(g.view(g.shape[0], -1), dim=-1).mean() for g in (prior_grad, likelihood_grad, grad)]
+                    stats.append(loss_utils.simple_likelihood_loss(y, A, x_mod, hparams, efficient_inp).mean())
+                    prior_grad_norm, likelihood_grad_norm, grad_norm, likelihood_loss = torch.stack(stats).tolist()
 
                     print(fmtstr % (t, step_size, likelihood_loss, prior_grad_norm, likelihood_grad_norm, grad_norm))
       
@@ -11,40 +11,39 @@ from PIL import Image
 import torch.nn.functional as F
 import torchvision
 import pickle
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.metrics_utils import Metrics
 from learners.meta_learner import MetaLearner
 from utils.loss_utils import get_measurements, get_transpose_measurements
 
-def save_image(image, path):
-    """Save a pytorch image as a png file"""
-    image = image.detach().cpu().numpy() #image comes in as an [C, H, W] torch tensor
-    x_png = np.uint8(np.clip(image*256,0,255))
-    x_png = x_png.transpose(1,2,0)
+def quantize_images(images):
+    """Map float images in [0, 1] to uint8 on whatever device they live on, so only bytes go to the host"""
+    if images.dtype == torch.uint8: #already quantized
+        return images
+    return images.detach().mul(256).clamp_(0, 255).to(torch.uint8)
+
+def save_image(image, path, compress_level=1):
+    """
+    Save a pytorch image as a png file.
+    compress_level is the zlib level (0-9) - the low default trades slightly larger files for much faster writes.
+    """
+    #image comes in as an [C, H, W] torch tensor, either float or already quantized
+    image = quantize_images(image)
+    x_png = image.permute(1, 2, 0).cpu().numpy()
     if x_png.shape[-1] == 1:
         x_png = x_png[:,:,0]
-    x_png = Image.fromarray(x_png).save(path)
+    x_png = Image.fromarray(x_png).save(path, compress_level=compress_level)
 
-def save_images(est_images, save_prefix):
+def save_images(est_images, save_prefix, compress_level=1):
     """Save a batch of images (in a dictionary) to png files"""
-    for image_num, image in est_images.items():
-        save_image(image, os.path.join(save_prefix, str(image_num)+'.png'))
+    #quantize the batch together and bring it to the host with one transfer instead of one per image
+    image_nums = list(est_images.keys())
+    images = quantize_images(torch.stack([est_images[num] for num in image_nums])).cpu()
 
-def save_measurement_images(est_images, hparams, save_prefix, noisy=False, noise_vars=None):
-    """Save a batch of image measurements to png files"""
-    A_type = hparams.problem.measurement_type
-
-    if A_type not in ['superres', 'inpaint', 'identity']:
-        print("\nCan't save given measurement type\n")
-        return
-
-    for image_num, image in est_images.items():
-        if A_type == 'inpaint' or A_type == 'identity':
-            image = get_measurements(None, image, hparams, True, noisy, noise_vars)
-        elif A_type == 'superres':
-            image = get_measurements(None, image.unsqueeze(0), hparams, noisy, noise_vars)
-            image = get_transpose_measurements(None, image, hparams).squeeze(0)
-        save_image(image, os.path.join(save_prefix, str(image_num) + '.png'))
+    for image_num, image in zip(image_nums, images):
+        save_image(image, os.path.join(save_prefix, str(image_num)+'.png'), compress_level)
 
 def save_to_pickle(data, pkl_filepath):
     """Save the data to a pickle file"""
@@ -60,6 +59,61 @@ def load_if_pickled(pkl_filepath):
         data = {}
     return data
 
+def clone_tensors(data):
+    """Copy the dicts and lists in a nested structure, cloning any tensors and leaving other values shared"""
+    if torch.is_tensor(data):
+        return data.detach().clone()
+    if isinstance(data, dict):
+        return {key: clone_tensors(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(clone_tensors(value) for value in data)
+    return data
+
+def append_to_pickle(data_list, pkl_filepath):
+    """Append each item of a list to a pickle stream file"""
+    with open(pkl_filepath, 'ab') as pkl_file:
+        for data in data_list:
+            pickle.dump(data, pkl_file)
+
+def load_pickle_stream(pkl_filepath):
+    """Load every item written by append_to_pickle as a list. Empty list if the file doesn't exist"""
+    data = []
+    if os.path.isfile(pkl_filepath):
+        with open(pkl_filepath, 'rb') as pkl_file:
+            while True:
+                try:
+                    data.append(pickle.load(pkl_file))
+                except EOFError:
+                    break
+    return data
+
+def load_metrics(metrics_root):
+    """
+    Rebuild the dict returned by the old get_metrics_dict from a run's metrics folder:
+        metrics.pickle holds the range and best_* dicts, and {train,val,test}_metrics.pickle are streams
+        of (iterkey, raw_metrics, aggregate_metrics) rows appended at each checkpoint.
+    """
+    out_dict = load_if_pickled(os.path.join(metrics_root, 'metrics.pickle'))
+
+    for iter_type in ['train', 'val', 'test']:
+        rows = load_pickle_stream(os.path.join(metrics_root, iter_type + '_metrics.pickle'))
+        out_dict[iter_type + '_metrics'] = {key: raw for key, raw, _ in rows}
+        out_dict[iter_type + '_metrics_aggregate'] = {key: agg for key, _, agg in rows}
+
+    return out_dict
+
+def load_checkpoint(log_dir):
+    """
+    Load a run's checkpoint.pickle along with the full c_list, grads, and grad_norms histories 
+        from their append-only pickle streams.
+    """
+    out_dict = load_if_pickled(os.path.join(log_dir, 'checkpoint.pickle'))
+
+    for key in ['c_list', 'grads', 'grad_norms']:
+        out_dict[key] = load_pickle_stream(os.path.join(log_dir, key + '.pickle'))
+
+    return out_dict
+
 class Logger:
     """
     Class for saving, checkpointing, and logging various things
@@ -74,6 +128,21 @@ class Logger:
         self.metrics = metrics
         self.learner = learner
 
+        #measurement images keyed by image number - the same val/test images get logged several times
+        self.measurement_cache = {}
+
+        #single worker so checkpoint writes land in order
+        self.checkpoint_pool = ThreadPoolExecutor(max_workers=1)
+        self.checkpoint_future = None
+        #how many metric rows and gradient norms have already been handed to the writer
+        self.metrics_written = {'train': 0, 'val': 0, 'test': 0}
+        self.grad_norms_written = 0
+
+        #png writes are pure host I/O, so they run in the background while the next step computes
+        self.image_pool = ThreadPoolExecutor(max_workers=2)
+        self.image_futures = []
+        self.image_dirs = set()
+
         self.__make_log_folder()
         self.__save_config()
 
@@ -94,9 +163,24 @@ class Logger:
             yaml.dump(self.hparams, f, default_flow_style=False)
     
     def checkpoint(self):
+        """
+        Snapshots the learner and metrics state and writes it out on a background thread,
+            so the disk I/O overlaps with the next outer iterations.
+        Call wait_for_checkpoint() before exiting to make sure the last write landed.
+        """
+        #surfaces any error from the previous write, and keeps at most one write in flight
+        self.wait_for_checkpoint()
+        self.wait_for_images()
+
+        #training keeps mutating the learner and metrics state, so the writer only gets what it needs:
+        #the iterations finished since the last checkpoint, and copies of the few tensors updated in place
         checkpoint_dict = self.get_checkpoint_dict()
-        metrics_dict = self.get_metrics_dict()
-        if hasattr(self.learner, 'meta_scheduler'):
+        checkpoint_dict['c'] = checkpoint_dict['c'].detach().to('cpu', copy=True)
+        metrics_dict = copy.deepcopy(self.get_best_metrics_dict())
+        new_rows = self.__get_new_metric_rows()
+        new_norms = self.learner.grad_norms[self.grad_norms_written:]
+        self.grad_norms_written += len(new_norms)
+        if self.learner.meta_scheduler is not None:
             states = [
                 self.learner.meta_opt.state_dict(),
                 self.learner.meta_scheduler.state_dict()
@@ -105,34 +189,84 @@ class Logger:
             states = [
                 self.learner.meta_opt.state_dict()
             ]
+        states = clone_tensors(states)
+
+        #take ownership of the learner's pending c and gradient snapshots so they don't accumulate in memory
+        new_cs = self.learner.c_list
+        self.learner.c_list = []
+        new_grads = self.learner.grads
+        self.learner.grads = []
+
+        self.checkpoint_future = self.checkpoint_pool.submit(self.__write_checkpoint, 
+                                    metrics_dict, new_rows, checkpoint_dict, states, new_cs, new_grads, new_norms)
+
+        return
+    
+    def wait_for_checkpoint(self):
+        """Blocks until the last submitted checkpoint has been written"""
+        if self.checkpoint_future is not None:
+            self.checkpoint_future.result()
+            self.checkpoint_future = None
 
+        return
+    
+    def wait_for_images(self):
+        """Blocks until every submitted image save has been written"""
+        for future in self.image_futures:
+            future.result()
+        self.image_futures = []
+
+        return
+    
+    def __write_checkpoint(self, metrics_dict, new_rows, checkpoint_dict, states, new_cs, new_grads, new_norms):
         save_to_pickle(metrics_dict, os.path.join(self.metrics_root, 'metrics.pickle'))
         save_to_pickle(checkpoint_dict, os.path.join(self.log_dir, 'checkpoint.pickle'))
         torch.save(states, os.path.join(self.log_dir, 'states.pth'))
 
+        #the per-iteration histories only grow, so each checkpoint appends what was added since the last one
+        #instead of rewriting everything. read back with load_pickle_stream
+        for iter_type, rows in new_rows.items():
+            if len(rows) > 0:
+                append_to_pickle(rows, os.path.join(self.metrics_root, iter_type + '_metrics.pickle'))
+        if len(new_cs) > 0:
+            append_to_pickle(new_cs, os.path.join(self.log_dir, 'c_list.pickle'))
+        if len(new_grads) > 0:
+            append_to_pickle(new_grads, os.path.join(self.log_dir, 'grads.pickle'))
+        if len(new_norms) > 0:
+            append_to_pickle(new_norms, os.path.join(self.log_dir, 'grad_norms.pickle'))
+
         return
     
+    def __get_new_metric_rows(self):
+        """
+        Returns {iter_type: [(iterkey, raw_metrics, aggregate_metrics), ...]} for every iteration
+            aggregated since the last checkpoint. A row is finished once it has been aggregated.
+        """
+        new_rows = {}
+
+        for iter_type in ['train', 'val', 'test']:
+            raw_dict = self.metrics.get_dict(iter_type, dict_type='raw')
+            agg_dict = self.metrics.get_dict(iter_type, dict_type='aggregate')
+
+            new_keys = list(agg_dict.keys())[self.metrics_written[iter_type]:]
+            new_rows[iter_type] = [(key, dict(raw_dict[key]), dict(agg_dict[key])) for key in new_keys]
+            self.metrics_written[iter_type] += len(new_keys)
+
+        return new_rows
+    
     def get_checkpoint_dict(self):
         out_dict = {
             #'A': self.learner.A,
             'global_iter': self.learner.global_iter,
             'best_iter': self.learner.best_iter,
-            'c_list': self.learner.c_list,
-            'c': self.learner.c,
-            'grad_norms': self.learner.grad_norms,
-            'grads': self.learner.grads
+            'best_c': self.learner.best_c,
+            'c': self.learner.c
         }
         return out_dict
     
-    def get_metrics_dict(self):
+    def get_best_metrics_dict(self):
         out_dict = {
             'range': self.metrics.range,
-            'train_metrics': self.metrics.train_metrics,
-            'val_metrics': self.metrics.val_metrics,
-            'test_metrics': self.metrics.test_metrics,
-            'train_metrics_aggregate': self.metrics.train_metrics_aggregate,
-            'val_metrics_aggregate': self.metrics.val_metrics_aggregate,
-            'test_metrics_aggregate': self.metrics.test_metrics_aggregate,
             'best_train_metrics': self.metrics.best_train_metrics,
             'best_val_metrics': self.metrics.best_val_metrics,
             'best_test_metrics': self.metrics.best_test_metrics
@@ -140,31 +274,63 @@ class Logger:
 
         return out_dict
     
-    def save_image_measurements(self, images, image_nums, save_prefix):
-        save_path = os.path.join(self.image_root, save_prefix)
+    def __get_measurement_images(self, images, image_nums):
+        """
+        Returns the measurement images for a batch as a cpu tensor.
+        Only images whose number hasn't been seen before are pushed through the forward operator.
+        Noisy measurements get fresh noise on every call, so they are never cached.
+        """
+        A_type = self.hparams.problem.measurement_type
 
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
+        if self.learner.noisy:
+            cache = {}
+        else:
+            cache = self.measurement_cache
 
-        image_dict = {}
+        missing = [i for i, num in enumerate(image_nums) if num not in cache]
 
-        for i in range(images.shape[0]):
-            image_dict[image_nums[i]] = images[i]
-        
-        save_measurement_images(image_dict, self.hparams, save_path, noisy=self.learner.noisy, noise_vars=self.learner.noise_vars)
+        if len(missing) > 0:
+            new_images = images[missing]
+
+            if A_type == 'inpaint' or A_type == 'identity':
+                new_images = get_measurements(None, new_images, self.hparams, True, 
+                                    noisy=self.learner.noisy, noise_vars=self.learner.noise_vars)
+            elif A_type == 'superres':
+                new_images = get_measurements(None, new_images, self.hparams, 
+                                    noisy=self.learner.noisy, noise_vars=self.learner.noise_vars)
+                new_images = get_transpose_measurements(None, new_images, self.hparams)
+
+            new_images = new_images.detach().cpu()
+            for j, i in enumerate(missing):
+                cache[image_nums[i]] = new_images[j]
+
+        return torch.stack([cache[num] for num in image_nums])
+
+    def save_image_measurements(self, images, image_nums, save_prefix):
+        if self.hparams.problem.measurement_type not in ['superres', 'inpaint', 'identity']:
+            print("\nCan't save given measurement type\n")
+            return
+
+        images = self.__get_measurement_images(images, image_nums)
+
+        self.save_images(images, image_nums, save_prefix)
 
     def save_images(self, images, image_nums, save_prefix):
         save_path = os.path.join(self.image_root, save_prefix)
 
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
+        if save_path not in self.image_dirs:
+            os.makedirs(save_path, exist_ok=True)
+            self.image_dirs.add(save_path)
+
+        #one device->host copy of the quantized batch here, the png encoding and writes happen on the pool
+        images = quantize_images(images).cpu()
 
         image_dict = {}
 
         for i in range(images.shape[0]):
             image_dict[image_nums[i]] = images[i]
         
-        save_images(image_dict, save_path)
+        self.image_futures.append(self.image_pool.submit(save_images, image_dict, save_path))
     
     def save_image_measurements_torch(self, images, image_nums, save_prefix):
         A_type = self.hparams.problem.measurement_type
@@ -188,10 +354,11 @@ class Logger:
     
     def add_tb_images(self, images, tag):
         step = self.learner.global_iter
-        grid_img = torchvision.utils.make_grid(images.cpu(), nrow=images.shape[0]//2)
+        #tile on the device and move the finished grid to the host in one copy
+        grid_img = torchvision.utils.make_grid(images.detach(), nrow=max(1, images.shape[0]//2)).cpu()
         self.tb_logger.add_image(tag, grid_img, global_step=step)
 
-    def add_tb_measurement_images(self, images, tag):
+    def add_tb_measurement_images(self, images, tag, image_nums):
         step = self.learner.global_iter
 
         A_type = self.hparams.problem.measurement_type
@@ -200,14 +367,9 @@ class Logger:
             print("\nCan't save given measurement type\n")
             return
 
-        if A_type == 'inpaint' or A_type == 'identity':
-            images = get_measurements(None, images, self.hparams, True, self.learner.noisy, self.learner.noise_vars)
-        elif A_type == 'superres':
-            images = get_measurements(None, images, self.hparams, self.learner.noisy, self.learner.noise_vars)
-            images = get_transpose_measurements(None, images, self.hparams)
-            
+        images = self.__get_measurement_images(images, image_nums)
 
-        grid_img = torchvision.utils.make_grid(images.cpu(), nrow=images.shape[0]//2)
+        grid_img = torchvision.utils.make_grid(images, nrow=max(1, images.shape[0]//2))
         self.tb_logger.add_image(tag, grid_img, global_step=step)
 
     def add_metrics_to_tb(self, iter_type='train'):
@@ -229,9 +391,9 @@ class Logger:
             print("\ncurrent iteration has not yet been logged\n")
             return
         
+        #one histogram event per metric rather than an add_scalars event (and sub-writer) per image
         for metric_type, metric_value in raw_dict[iterkey].items():
-            for i, val in enumerate(metric_value):
-                self.tb_logger.add_scalars("raw " + metric_type, {iter_type: val}, i)
+            self.tb_logger.add_histogram("raw " + metric_type + "/" + iter_type, np.asarray(metric_value), step)
         
         for metric_type, metric_value in agg_dict[iterkey].items():
             self.tb_logger.add_scalars(metric_type, {iter_type: metric_value}, step)
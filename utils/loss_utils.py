@@ -1,6 +1,7 @@
 import torch
 import torch.nn.functional as F
 import numpy as np
+from functools import lru_cache
 
 def get_A(hparams):
     A_type = hparams.problem.measurement_type
@@ -23,22 +24,49 @@ def get_A(hparams):
 
     return A
 
-def get_inpaint_mask(hparams):
+def get_inpaint_mask(hparams, device='cpu'):
+    """
+    Returns the [C, H, W] inpainting mask on the given device.
+    The mask is a constant of the experiment, so it is built once per device and shared -
+        treat the returned tensor as read-only.
+    """
+    image_size = hparams.data.image_size
+    inpaint_size = hparams.problem.inpaint_size
+    image_shape = tuple(hparams.data.image_shape)
+
+    return _build_inpaint_mask(image_shape, image_size, inpaint_size, torch.device(device))
+
+def get_inpaint_kept_inds(hparams, device='cpu'):
+    """
+    Returns the flat indices of the pixels the inpainting mask keeps, cached per device like the mask.
+    """
     image_size = hparams.data.image_size
     inpaint_size = hparams.problem.inpaint_size
-    image_shape = hparams.data.image_shape
+    image_shape = tuple(hparams.data.image_shape)
 
+    return _build_inpaint_kept_inds(image_shape, image_size, inpaint_size, torch.device(device))
+
+@lru_cache(maxsize=None)
+def _build_inpaint_mask(image_shape, image_size, inpaint_size, device):
     margin = (image_size - inpaint_size) // 2
     mask = torch.ones(image_shape)
     mask[:, margin:margin+inpaint_size, margin:margin+inpaint_size] = 0
 
-    return mask
+    return mask.to(device)
+
+@lru_cache(maxsize=None)
+def _build_inpaint_kept_inds(image_shape, image_size, inpaint_size, device):
+    mask = _build_inpaint_mask(image_shape, image_size, inpaint_size, device)
+
+    return (mask.flatten()>0).nonzero(as_tuple=False).flatten()
 
 def get_A_inpaint(hparams):
-    mask = get_inpaint_mask(hparams).numpy()
-    mask = mask.reshape(1, -1)
-    A = np.eye(np.prod(mask.shape)) * np.tile(mask, [np.prod(mask.shape), 1])
-    A = np.asarray([a for a in A if np.sum(a) != 0]) #keep rows with 1s in them
+    mask = get_inpaint_mask(hparams).numpy().flatten()
+    kept_inds = np.flatnonzero(mask)
+
+    #rows of the identity at the kept pixels, scattered directly instead of masking a full n x n eye
+    A = np.zeros((len(kept_inds), len(mask)))
+    A[np.arange(len(kept_inds)), kept_inds] = 1
 
     return torch.from_numpy(A)
 
@@ -51,16 +79,15 @@ def get_measurements(A, x, hparams, efficient_inp=False, noisy=False, noise_vars
     A_type = hparams.problem.measurement_type
 
     if A_type == 'gaussian':
-        Ax = torch.mm(A, torch.flatten(x, start_dim=1).T).T #[N, m]
+        Ax = torch.mm(torch.flatten(x, start_dim=1), A.T) #[N, m]
     elif A_type == 'inpaint' and efficient_inp:
-        Ax = get_inpaint_mask(hparams).to(x.device) * x #[N, C, H, W]
+        Ax = get_inpaint_mask(hparams, x.device) * x #[N, C, H, W]
     elif A_type == 'inpaint' and not efficient_inp:
-        Ax = torch.mm(A, torch.flatten(x, start_dim=1).T).T #[N, m]
+        Ax = torch.mm(torch.flatten(x, start_dim=1), A.T) #[N, m]
     elif A_type == 'superres':
         Ax = F.avg_pool2d(x, hparams.problem.downsample_factor) #[N, C, H//downsample_factor, W//downsample_factor]
     elif A_type == 'identity':
-        I = torch.nn.Identity()
-        Ax = I(x)
+        Ax = x
     else:
         raise NotImplementedError #TODO implement circulant!!
     
@@ -77,12 +104,11 @@ def get_transpose_measurements(A, vec, hparams):
     A_type = hparams.problem.measurement_type
 
     if A_type == 'gaussian' or A_type == 'inpaint':
-        ans = torch.mm(A.T, vec.T).T
+        ans = torch.mm(vec, A) #[N, n], row-major so callers can view it as images
     elif A_type == 'superres': #make sure y is in the right shape
         ans = F.interpolate(vec, scale_factor=hparams.problem.downsample_factor)
     elif A_type == 'identity':
-        I = torch.nn.Identity()
-        ans = I(vec)
+        ans = vec
     else:
         raise NotImplementedError #TODO implement circulant!!
     
@@ -103,27 +129,30 @@ def gradient_log_cond_likelihood(c_orig, y, A, x, hparams, scale=1):
     Ax = get_measurements(A, x, hparams) 
     resid = Ax - y 
 
+    #scale is folded into c (or the [N, k] intermediate) so it costs one multiply on the smallest tensor
+    #instead of extra full-size passes over the [N, C, H, W] output of the adjoint
     if c_type == 'scalar':
-        grad = scale * c * get_transpose_measurements(A, resid, hparams)
+        grad = get_transpose_measurements(A, (scale * c) * resid, hparams)
 
     elif c_type == 'vector':
         if A_type == 'superres' or A_type == 'identity':
             c_shaped = c.view(hparams.problem.y_shape)
-            grad = scale * get_transpose_measurements(A, c_shaped * resid, hparams)
+            grad = get_transpose_measurements(A, (scale * c_shaped) * resid, hparams)
 
         else:
-            grad = scale * get_transpose_measurements(A, c * resid, hparams)
+            grad = get_transpose_measurements(A, (scale * c) * resid, hparams)
 
     elif c_type == 'matrix':
+        #resid @ c.T @ c, applied right to left on the batch - never forms the [m, m] matrix c.T @ c
         if A_type == 'superres' or A_type == 'identity':
             y_c, y_h, y_w = hparams.problem.y_shape
-            vec = torch.mm(c, resid.flatten(start_dim=1).T).T #[N, k]
-            vec = (torch.mm(c.T, vec.T).T).view(-1, y_c, y_h, y_w) #[N, (y_shape)]
+            vec = scale * torch.mm(resid.flatten(start_dim=1), c.T) #[N, k]
+            vec = torch.mm(vec, c).view(-1, y_c, y_h, y_w) #[N, (y_shape)]
 
         else:
-            vec = torch.mm(torch.mm(c.T, c), resid.T).T #[N, m] 
+            vec = torch.mm(scale * torch.mm(resid, c.T), c) #[N, m] 
 
-        grad = scale * get_transpose_measurements(A, vec, hparams)
+        grad = get_transpose_measurements(A, vec, hparams)
 
     else:
         raise NotImplementedError
@@ -155,29 +184,25 @@ def log_cond_likelihood_loss(c_orig, y, A, x, hparams, scale=1, efficient_inp=Fa
     #      We can flatten and use normally as size of c accounts for this.
     #NOTE: Efficient Inpaint has extraneous areas of 0 entry that c shape does not account for.
     #      We have to isolate the measurement region to play nice with c.
-    Ax = get_measurements(A, x, hparams, efficient_inp) 
-    resid = Ax - y 
+    #      The mask is 1 exactly on the kept pixels, so gathering them from x and y directly gives the
+    #      same residual as masking x first - without the full-size multiply and subtraction.
+    inp_gather = A_type == 'inpaint' and efficient_inp and c_type != 'scalar'
+
+    if inp_gather:
+        kept_inds = get_inpaint_kept_inds(hparams, x.device)
+        resid = x.flatten(start_dim=1).index_select(1, kept_inds) - y.flatten(start_dim=1).index_select(1, kept_inds) #[N, m]
+    else:
+        Ax = get_measurements(A, x, hparams, efficient_inp) 
+        resid = Ax - y 
 
     if c_type == 'scalar':
         loss = scale * c * 0.5 * torch.sum(resid ** 2)
 
     elif c_type == 'vector':
-        if A_type == 'inpaint' and efficient_inp:
-            mask = get_inpaint_mask(hparams)
-            kept_inds = (mask.flatten()>0).nonzero(as_tuple=False).flatten()
-            loss = scale * 0.5 * torch.sum(c * (resid ** 2).flatten(start_dim=1)[:,kept_inds])
-
-        else:    
-            loss = scale * 0.5 * torch.sum(c * (resid ** 2).flatten(start_dim=1))
+        loss = scale * 0.5 * torch.sum(c * (resid ** 2).flatten(start_dim=1))
 
     elif c_type == 'matrix':
-        if A_type == 'inpaint' and efficient_inp:
-            mask = get_inpaint_mask(hparams)
-            kept_inds = (mask.flatten()>0).nonzero(as_tuple=False).flatten()
-            interior = torch.mm(c, resid.flatten(start_dim=1)[:,kept_inds].T).T #[N, k]
-
-        else:
-            interior = torch.mm(c, resid.flatten(start_dim=1).T).T #[N, k]
+        interior = torch.mm(resid.flatten(start_dim=1), c.T) #[N, k]
 
         loss = scale * 0.5 * torch.sum(interior ** 2)
 
@@ -204,8 +229,14 @@ def get_likelihood_grad(c_orig, y, A, x, hparams, scale=1, efficient_inp=False,\
     """
     A method for choosing between gradient_log_cond_likelihood (explicitly-formed gradient)
         and log_cond_likelihood_loss with autograd. 
+    The explicit gradient is exact for gaussian and identity measurements, so those always use it - 
+        autograd would only add saved activations and a backward pass. 
+    Superres keeps autograd when requested: get_transpose_measurements upsamples with F.interpolate, which is 
+        downsample_factor**2 times the true adjoint of avg_pool2d. Inpainting keeps it since A isn't formed then.
     """
-    if hparams.outer.use_autograd:
+    A_type = hparams.problem.measurement_type
+
+    if hparams.outer.use_autograd and A_type not in ['gaussian', 'identity']:
         grad_flag_x = x.requires_grad
         x.requires_grad_()
         likelihood_grad = torch.autograd.grad(log_cond_likelihood_loss\
@@ -221,16 +252,14 @@ def meta_loss(x_hat, x_true, hparams):
     meta_type = hparams.outer.meta_loss_type
     ROI = hparams.outer.ROI
 
-    sse = torch.nn.MSELoss(reduction='sum')
-
     if meas_loss or meta_type != "l2":
         raise NotImplementedError
     
     if ROI:
-        ROI = getRectMask(hparams).to(x_hat.device)
-        return 0.5 * sse(ROI*x_hat, ROI*x_true)
+        ROI = getRectMask(hparams, x_hat.device)
+        return 0.5 * F.mse_loss(ROI*x_hat, ROI*x_true, reduction='sum')
     else:
-        return 0.5 * sse(x_hat, x_true)
+        return 0.5 * F.mse_loss(x_hat, x_true, reduction='sum')
 
 def elementwise_meta_loss(x_hat, x_true, hparams):
     """
@@ -244,7 +273,7 @@ def elementwise_meta_loss(x_hat, x_true, hparams):
         raise NotImplementedError
 
     if ROI:
-        ROI = getRectMask(hparams).to(x_hat.device)
+        ROI = getRectMask(hparams, x_hat.device)
         roi_diff = ROI * (x_hat - x_true)
         loss = torch.sum(roi_diff**2, dim=[1,2,3])
     else:
@@ -262,9 +291,10 @@ def grad_meta_loss(x_hat, x_true, hparams):
         raise NotImplementedError
     
     if ROI:
-        ROI_mat = get_ROI_matrix(hparams).to(x_hat.device).float()
-        vec = torch.mm(ROI_mat, torch.flatten(x_hat - x_true, start_dim=1).T).T #[N, roi_num]
-        return (torch.mm(ROI_mat.T, vec.T).T).view(x_hat.shape) 
+        #R^T R for the row-selection matrix R = get_ROI_matrix is just the diagonal ROI mask,
+        #so the projection is an elementwise multiply rather than two mms with a dense [roi_num, n] matrix
+        ROI = getRectMask(hparams, x_hat.device)
+        return ROI * (x_hat - x_true) #[N, C, H, W]
     else:
         return (x_hat - x_true) #[N, C, H, W]
 
@@ -292,9 +322,18 @@ def get_ROI_matrix(hparams):
 
     return torch.from_numpy(A)
 
-def getRectMask(hparams):
-    shape = hparams.data.image_shape
+def getRectMask(hparams, device='cpu'):
+    """
+    Returns the [C, H, W] ROI mask on the given device.
+    Built once per device and shared like the inpainting mask - treat it as read-only.
+    """
+    shape = tuple(hparams.data.image_shape)
     offsets, hw = hparams.outer.ROI
+
+    return _build_rect_mask(shape, tuple(offsets), tuple(hw), torch.device(device))
+
+@lru_cache(maxsize=None)
+def _build_rect_mask(shape, offsets, hw, device):
     h_offset, w_offset = offsets
     height, width = hw
 
@@ -302,18 +341,22 @@ def getRectMask(hparams):
 
     mask_tensor[:, h_offset:h_offset+height, w_offset:w_offset+width] = 1
 
-    return mask_tensor
+    return mask_tensor.to(device)
 
 def get_loss_dict(y, A, x_hat, x, hparams, efficient_inp=False):
     """
     Calculates and returns a dictionary with the measurement loss and te meta loss
     """
-    cur_meta_loss = elementwise_meta_loss(x_hat, x, hparams).detach().cpu().numpy().flatten()
-    cur_likelihood_loss = simple_likelihood_loss(y, A, x_hat, hparams, efficient_inp).detach().cpu().numpy().flatten()
+    with torch.no_grad():
+        cur_meta_loss = elementwise_meta_loss(x_hat, x, hparams)
+        cur_likelihood_loss = simple_likelihood_loss(y, A, x_hat, hparams, efficient_inp)
+
+        #one device->host transfer for both losses instead of one per loss
+        losses = torch.stack([cur_meta_loss, cur_likelihood_loss]).cpu().numpy()
 
     out_dict = {
-        'meta_loss': cur_meta_loss,
-        'likelihood_loss': cur_likelihood_loss
+        'meta_loss': losses[0],
+        'likelihood_loss': losses[1]
     }
 
     return out_dict
@@ -1,15 +1,24 @@
 """
 Class for calculating metrics for a proposed image and the original.
 NOTE: all methods return per-image metrics, i.e. the number of returned values is equal to batch dimension. 
+      The get_* helpers return [N] tensors on the input device; get_all_metrics moves them to numpy.
 """
 import lpips
 import torch
 import torch.nn.functional as F
 import numpy as np
+from functools import lru_cache
 from pytorch_msssim import ssim, ms_ssim
 
 from utils.loss_utils import getRectMask 
 
+@lru_cache(maxsize=None)
+def get_lpips_model(device):
+    """
+    Builds the LPIPS network once per device - constructing it loads AlexNet weights from disk.
+    """
+    return lpips.LPIPS(net='alex', verbose=False).to(device).eval()
+
 @torch.no_grad()
 def get_lpips(x_hat, x):
     """
@@ -19,23 +28,32 @@ def get_lpips(x_hat, x):
     x_hat_rescaled = (x_hat * 2.) - 1
     x_rescaled = (x * 2.) - 1
 
-    loss_fn = lpips.LPIPS(net='alex').to(x_hat.device)
+    loss_fn = get_lpips_model(x_hat.device)
     lpips_loss = loss_fn.forward(x_hat_rescaled, x_rescaled)
 
-    return lpips_loss.cpu().numpy().flatten()
+    return lpips_loss.flatten()
+
+#image shapes ms-ssim has already failed on - checked so we don't retry (and re-print) every batch
+_MSSSIM_UNSUPPORTED_SHAPES = set()
 
 @torch.no_grad()
 def get_msssim(x_hat, x, range=1.):
     """
     Calculates MS-SSIM(x_hat, x)
     """
+    image_shape = tuple(x_hat.shape[1:])
+
+    if image_shape in _MSSSIM_UNSUPPORTED_SHAPES:
+        return torch.zeros(x_hat.shape[0], device=x_hat.device)
+
     try:
         ms_ssim_val = ms_ssim(x_hat, x, data_range=range, size_average=False)
     except Exception as e:
         print("\nCurrent data is too small (", e.__class__, " occurred). Not using ms-ssim.\n")
-        ms_ssim_val = torch.zeros(x_hat.shape[0])
+        _MSSSIM_UNSUPPORTED_SHAPES.add(image_shape)
+        ms_ssim_val = torch.zeros(x_hat.shape[0], device=x_hat.device)
 
-    return ms_ssim_val.cpu().numpy().flatten()
+    return ms_ssim_val.flatten()
 
 @torch.no_grad()
 def get_ssim(x_hat, x, range=1.):
@@ -44,7 +62,7 @@ def get_ssim(x_hat, x, range=1.):
     """
     ssim_val = ssim(x_hat, x, data_range=range, size_average=False)
 
-    return ssim_val.cpu().numpy().flatten()
+    return ssim_val.flatten()
 
 @torch.no_grad()
 def get_nmse(x_hat, x):
@@ -56,7 +74,7 @@ def get_nmse(x_hat, x):
 
     nmse_val = sse / denom
 
-    return nmse_val.cpu().numpy().flatten() 
+    return nmse_val.flatten() 
 
 @torch.no_grad()
 def get_psnr(x_hat, x, range=1.):
@@ -66,9 +84,10 @@ def get_psnr(x_hat, x, range=1.):
     """
     mse = torch.sum((x_hat - x)**2, dim=[1,2,3]) / np.prod(x_hat.shape[1:]) #shape [N]
 
-    psnr_val = 20 * torch.log10(range / torch.sqrt(mse))
+    #same value as 20 * log10(range / sqrt(mse)), without the elementwise sqrt and division
+    psnr_val = 10 * torch.log10(range**2 / mse)
 
-    return psnr_val.cpu().numpy().flatten() #shape [N] - per-image psnr
+    return psnr_val.flatten() #shape [N] - per-image psnr
 
 @torch.no_grad()
 def get_sse(x_hat, x):
@@ -77,7 +96,7 @@ def get_sse(x_hat, x):
     """
     sse_val = torch.sum((x_hat - x)**2, dim=[1,2,3])
 
-    return sse_val.cpu().numpy().flatten() #shape [N] - sse per image
+    return sse_val.flatten() #shape [N] - sse per image
 
 @torch.no_grad()
 def get_mse(x_hat, x):
@@ -86,33 +105,53 @@ def get_mse(x_hat, x):
     """
     mse_val = torch.sum((x_hat - x)**2, dim=[1,2,3])
 
-    return mse_val.cpu().numpy().flatten() / np.prod(x_hat.shape[1:])
+    return mse_val.flatten() / np.prod(x_hat.shape[1:])
 
 @torch.no_grad()
-def get_all_metrics(x_hat, x, range = 1., hparams=None):
+def get_error_metrics(x_hat, x, range=1.):
+    """
+    Calculates nmse, psnr, sse, and mse together from a single pass over the residual.
+    Same values as the individual getters, which each recompute the squared error.
+    """
+    sse = torch.sum((x_hat - x)**2, dim=[1,2,3]) #shape [N] - sse per image
+    mse = sse / np.prod(x_hat.shape[1:])
+
+    out_dict = {
+        'nmse': sse / torch.sum(x**2, dim=[1,2,3]),
+        'psnr': 10 * torch.log10(range**2 / mse),
+        'sse': sse,
+        'mse': mse
+    }
+
+    return out_dict
+
+@torch.no_grad()
+def get_all_metrics(x_hat, x, range = 1., hparams=None, full=True):
     """
     function for getting all image reference metrics and returning in a dict
+    full=False skips the network/multi-scale metrics (lpips, ms-ssim)
     """
     metrics = {}
 
-    metrics['lpips'] = get_lpips(x_hat, x)
-    metrics['ms-ssim'] = get_msssim(x_hat, x, range=range)
+    if full:
+        metrics['lpips'] = get_lpips(x_hat, x)
+        metrics['ms-ssim'] = get_msssim(x_hat, x, range=range)
     metrics['ssim'] = get_ssim(x_hat, x, range=range)
-    metrics['nmse'] = get_nmse(x_hat, x)
-    metrics['psnr'] = get_psnr(x_hat, x, range=range)
-    metrics['sse'] = get_sse(x_hat, x)
-    metrics['mse'] = get_mse(x_hat, x)
+    metrics.update(get_error_metrics(x_hat, x, range=range))
 
     ROI = hparams.outer.ROI
     if ROI:
-        ROI = getRectMask(hparams).to(x_hat.device)
+        ROI = getRectMask(hparams, x_hat.device)
         x_hat_ROI, x_ROI = x_hat*ROI, x*ROI
-        metrics['roi_nmse'] = get_nmse(x_hat_ROI, x_ROI)
-        metrics['roi_psnr'] = get_psnr(x_hat_ROI, x_ROI, range=range)
-        metrics['roi_sse'] = get_sse(x_hat_ROI, x_ROI)
-        metrics['roi_mse'] = get_mse(x_hat_ROI, x_ROI)
+        roi_metrics = get_error_metrics(x_hat_ROI, x_ROI, range=range)
+        for key, value in roi_metrics.items():
+            metrics['roi_' + key] = value
+
+    #bring every metric to the host with one transfer (and one sync) instead of one per metric
+    keys = list(metrics.keys())
+    values = torch.stack([metrics[key].float() for key in keys]).cpu().numpy()
 
-    return metrics
+    return {key: values[i] for i, key in enumerate(keys)}
 
 class Metrics:
     """
@@ -259,7 +298,10 @@ class Metrics:
         """
         cur_dict = self.__retrieve_dict(iter_type) #validate and retrieve the right dict
 
-        iter_metrics = get_all_metrics(x_hat, x, range = self.range, hparams=self.hparams) #calc the metrics
+        #lpips and ms-ssim are only worth their cost on train batches if asked for
+        full = iter_type != 'train' or self.hparams.outer.train_full_metrics
+
+        iter_metrics = get_all_metrics(x_hat, x, range = self.range, hparams=self.hparams, full=full) #calc the metrics
 
         self.__init_iter_dict(cur_dict, iter_num) #check that the iter dict is initialized
         
@@ -12,6 +12,8 @@ import scipy as sp
 import matplotlib.pyplot as plt
 import torch.nn.functional as F
 import torchvision
+from functools import lru_cache
+import copy
 from utils.loss_utils import get_measurements, get_transpose_measurements
 
 
@@ -106,7 +108,7 @@ def split_dataset(base_dataset: Dataset, hparams: Namespace):
 
     return out_dict
 
-def init_c(hparams):
+def init_c(hparams, device='cpu'):
     """
     Initializes the hyperparameters as a scalar, vector, or matrix.
 
@@ -117,6 +119,8 @@ def init_c(hparams):
                     hparams.outer.hyperparam_type - str in [scalar, vector, matrix]
                     hparams.problem.num_measurements - int
                     hparams.outer.hyperparam_init - int or float
+        device: The device to build the hyperparameters on.
+                Type: str or torch.device.
     
     Returns:
         c: The initialized hyperparameters.
@@ -129,12 +133,13 @@ def init_c(hparams):
     m = hparams.problem.num_measurements
     init_val = float(hparams.outer.hyperparam_init)
 
+    #built directly on the target device - the [m,m] matrix case is too large to stage on the host
     if c_type == 'scalar':
-        c = torch.tensor(init_val)
+        c = torch.tensor(init_val, device=device)
     elif c_type == 'vector':
-        c = torch.ones(m) * init_val
+        c = torch.full((m,), init_val, device=device)
     elif c_type == 'matrix':
-        c = torch.eye(m) * init_val
+        c = torch.eye(m, device=device).mul_(init_val)
     else:
         raise NotImplementedError
 
@@ -180,9 +185,33 @@ def get_meta_optimizer(opt_params, hparams):
 
     return out_dict
 
+#libyaml's C loader when pyyaml was built with it - same safe semantics, much faster parsing
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def load_yaml(path):
+    """
+    Safely loads a yaml file, parsing each version of the file only once per process.
+
+    Args:
+        path: The path of the yaml file to load.
+              Type: str.
+
+    Returns:
+        data: The parsed yaml contents. A fresh copy on every call, so callers are free to mutate it.
+              Type: dict.
+    """
+    path = os.path.abspath(path)
+
+    return copy.deepcopy(_load_yaml(path, os.path.getmtime(path)))
+
+@lru_cache(maxsize=None)
+def _load_yaml(path, mtime):
+    #mtime is only part of the key, so an edited file gets re-parsed
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_YAML_LOADER)
+
 def parse_config(config_path):
-    with open(config_path, 'r') as f:
-        hparams = yaml.safe_load(f)
+    hparams = load_yaml(config_path)
 
     if hparams['use_gpu']:
         num = hparams['gpu_num']
@@ -284,7 +313,7 @@ def plot_images(images, title, save=False, fname=None):
 
     fig = plt.figure(figsize=(1, 1))
 
-    grid_img = torchvision.utils.make_grid(images.cpu(), nrow=images.shape[0]//2).permute(1, 2, 0) 
+    grid_img = torchvision.utils.make_grid(images.cpu(), nrow=max(1, images.shape[0]//2)).permute(1, 2, 0) 
 
     ax = fig.add_subplot(1, 1, 1, frameon=False)
     ax.get_xaxis().set_visible(False)